@@ -36,7 +36,8 @@ Examples
 N/A
 """
 
-from core import Solver, Integrator
+from .core import Solver, Integrator
+from .methods import RK4
 
 
 __version__ = '0.0.1'
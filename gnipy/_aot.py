@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Ahead-of-time compilation of the loops in :mod:`gnipy._runner`.
+
+Run ``python -m gnipy._aot`` once (Numba is required) to build the
+extension module ``gnipy_kernels`` next to this file. The module does not
+need Numba at run time; :mod:`gnipy._runner` uses it when Numba is not
+installed. Only float64 (and, for the scalar multiply loop, complex128)
+scalars and C contiguous arrays are supported, and the loops run on a
+single thread.
+
+GNIPY is available under GNU GPL v3 license.
+Documentation guidelines are available `here <https://github.com/numpy/numpy/blob/master/doc/HOWTO_DOCUMENT.rst.txt>`_.
+"""
+
+import os
+
+from numba.pycc import CC
+
+from gnipy import _runner
+
+cc = CC('gnipy_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+cc.export('scalar_mul_array_f8', 'f8[::1](f8[::1], f8, i8)')(_runner._scalar_mul_array.py_func)
+cc.export('scalar_mul_array_c16', 'c16[::1](c16[::1], c16, i8)')(_runner._scalar_mul_array.py_func)
+cc.export('scalar_mul_number_f8', 'f8(f8, f8, i8)')(_runner._scalar_mul_number.py_func)
+cc.export('scalar_mul_number_c16', 'c16(c16, c16, i8)')(_runner._scalar_mul_number.py_func)
+cc.export('sv_array', 'UniTuple(f8[::1],2)(f8[::1], f8[::1], f8, i8)')(_runner._sv_array.py_func)
+cc.export('sv_number', 'UniTuple(f8,2)(f8, f8, f8, i8)')(_runner._sv_number.py_func)
+
+if __name__ == '__main__':
+	cc.compile()
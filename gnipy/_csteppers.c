@@ -0,0 +1,54 @@
+/*
+ * Compiled integration loops for the GNIPY library.
+ *
+ * Each function carries out a whole integration in place, so that
+ * Python calls into C once per integration instead of once per step.
+ * The functions are loaded with ctypes by gnipy/_csteppers.py.
+ *
+ * Build with:
+ *     cc -O3 -fopenmp -fPIC -shared -o gnipy/libgnipy_csteppers.so gnipy/_csteppers.c
+ * Without -fopenmp the loops are compiled serially.
+ *
+ * GNIPY is available under GNU GPL v3 license.
+ */
+
+#include <stddef.h>
+
+/* Same threshold as PARALLEL_MIN_SIZE in gnipy/_runner.py */
+#define PARALLEL_MIN_SIZE 8192
+
+/*
+ * Linear test equation y' = lam*y: multiply the n values of y
+ * by factor (e.g. 1+h*lam for explicit Euler), nsteps times.
+ */
+void gnipy_dahlquist(double *y, ptrdiff_t n, double factor, ptrdiff_t nsteps)
+{
+	ptrdiff_t k, i;
+
+	#pragma omp parallel private(k) if(n >= PARALLEL_MIN_SIZE)
+	for (k = 0; k < nsteps; k++) {
+		#pragma omp for simd
+		for (i = 0; i < n; i++)
+			y[i] *= factor;
+	}
+}
+
+/*
+ * Harmonic oscillator q' = p, p' = -q: nsteps steps of the
+ * Stormer-Verlet method with step size h on the n values of (q,p).
+ */
+void gnipy_stormer_verlet(double *q, double *p, ptrdiff_t n, double h, ptrdiff_t nsteps)
+{
+	ptrdiff_t k, i;
+	double half = 0.5*h;
+
+	#pragma omp parallel private(k) if(n >= PARALLEL_MIN_SIZE)
+	for (k = 0; k < nsteps; k++) {
+		#pragma omp for simd
+		for (i = 0; i < n; i++) {
+			q[i] += half*p[i];
+			p[i] -= h*q[i];
+			q[i] += half*p[i];
+		}
+	}
+}
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compiled C integration loops for the GNIPY library.
+
+Wrappers around the C functions in ``_csteppers.c``, loaded with ctypes.
+The shared library must be built beforehand (see ``_csteppers.c``).
+If it is not found, every loop in this module is ``None``.
+
+The wrappers follow the convention for :attr:`gnipy.core.Integrator._kernel`,
+i.e., they are called as ``kernel(state, *(constants+(nsteps,)))``.
+
+GNIPY is available under GNU GPL v3 license.
+Documentation guidelines are available `here <https://github.com/numpy/numpy/blob/master/doc/HOWTO_DOCUMENT.rst.txt>`_.
+"""
+
+import os
+import ctypes
+
+from numpy import ndarray, float64
+
+try:
+	_lib = ctypes.CDLL(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libgnipy_csteppers.so'))
+except OSError:
+	_lib = None
+
+
+def _pointer(y):
+	"""
+	Return a C double pointer to the data of the array `y`.
+	"""
+	if (not isinstance(y,ndarray) or y.dtype != float64 or not y.flags.c_contiguous):
+		raise AttributeError("Object %s must be a C contiguous float64 array."%str(type(y)))
+	return y.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+
+def _dahlquist(y, factor, nsteps):
+	"""
+	Multiply the array `y` in place by `factor`, `nsteps` times.
+	"""
+	_lib.gnipy_dahlquist(_pointer(y), ctypes.c_ssize_t(y.size),
+		ctypes.c_double(factor), ctypes.c_ssize_t(nsteps))
+	return y
+
+
+def _stormer_verlet(state, stepsize, nsteps):
+	"""
+	Integrate the harmonic oscillator in place with `nsteps` steps
+	of the Stormer-Verlet method. The state is a tuple (q,p).
+	"""
+	(q,p) = state
+	if (q.shape != p.shape):
+		raise AttributeError("Arrays q and p must have the same shape.")
+	_lib.gnipy_stormer_verlet(_pointer(q), _pointer(p), ctypes.c_ssize_t(q.size),
+		ctypes.c_double(stepsize), ctypes.c_ssize_t(nsteps))
+	return (q,p)
+
+
+if _lib is not None:
+	_lib.gnipy_dahlquist.restype = None
+	_lib.gnipy_stormer_verlet.restype = None
+	dahlquist = _dahlquist
+	stormer_verlet = _stormer_verlet
+else:
+	dahlquist = None
+	stormer_verlet = None
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+CUDA integration loops for ensembles of initial states.
+
+Each GPU thread integrates one member of the ensemble, i.e., one row
+of the state arrays, through all the steps. The host functions follow
+the convention for :attr:`gnipy.core.Integrator._cuda_kernel`: they are
+called as ``kernel(states, *(constants+(nsteps,)))``, copy the states to
+the device, and copy the final states back in place.
+
+The kernels are compiled with ``numba.cuda``. If it is not available,
+every loop in this module is ``None``.
+
+GNIPY is available under GNU GPL v3 license.
+Documentation guidelines are available `here <https://github.com/numpy/numpy/blob/master/doc/HOWTO_DOCUMENT.rst.txt>`_.
+"""
+
+try:
+	from numba import cuda
+except ImportError:
+	cuda = None
+
+from ._runner import _check_array
+
+THREADS_PER_BLOCK = 128
+
+
+def _rows(y):
+	"""
+	Return the array `y` as a 2D view, one row per member.
+	"""
+	return y.reshape(y.shape[0], y.size//y.shape[0])
+
+
+def _blocks(nmembers):
+	return (nmembers+THREADS_PER_BLOCK-1)//THREADS_PER_BLOCK
+
+
+if cuda is not None:
+
+	@cuda.jit
+	def _scalar_mul_kernel(y, factor, nsteps):
+		b = cuda.grid(1)
+		if b >= y.shape[0]:
+			return
+		for k in range(nsteps):
+			for i in range(y.shape[1]):
+				y[b,i] *= factor
+
+	@cuda.jit
+	def _sv_kernel(q, p, stepsize, nsteps):
+		b = cuda.grid(1)
+		if b >= q.shape[0]:
+			return
+		half = 0.5*stepsize
+		for k in range(nsteps):
+			for i in range(q.shape[1]):
+				q[b,i] += half*p[b,i]
+				p[b,i] -= stepsize*q[b,i]
+				q[b,i] += half*p[b,i]
+
+	def scalar_mul_loop(y, factor, nsteps):
+		"""
+		Multiply every member of the ensemble `y` by `factor`, `nsteps` times.
+		"""
+		_check_array(y)
+		if y.shape[0] == 0:
+			return y
+		rows = _rows(y)
+		d_rows = cuda.to_device(rows)
+		_scalar_mul_kernel[_blocks(rows.shape[0]), THREADS_PER_BLOCK](d_rows, factor, nsteps)
+		d_rows.copy_to_host(rows)
+		return y
+
+	def sv_loop(state, stepsize, nsteps):
+		"""
+		Integrate every member of the ensemble (q,p) of harmonic
+		oscillators with `nsteps` steps of the Stormer-Verlet method.
+		"""
+		(q,p) = state
+		if (q.shape != p.shape):
+			raise AttributeError("Arrays q and p must have the same shape.")
+		_check_array(q)
+		_check_array(p)
+		if q.shape[0] == 0:
+			return (q,p)
+		(qrows,prows) = (_rows(q),_rows(p))
+		(d_q,d_p) = (cuda.to_device(qrows),cuda.to_device(prows))
+		_sv_kernel[_blocks(qrows.shape[0]), THREADS_PER_BLOCK](d_q, d_p, stepsize, nsteps)
+		d_q.copy_to_host(qrows)
+		d_p.copy_to_host(prows)
+		return (q,p)
+
+else:
+	scalar_mul_loop = None
+	sv_loop = None
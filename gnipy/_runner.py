@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compiled integration loops for the GNIPY library.
+
+The loops are compiled with `Numba <http://numba.pydata.org>`_ if it is
+installed, and the machine code is cached on disk between processes.
+Without Numba, the loops are taken from the extension module
+``gnipy_kernels`` if it has been built ahead of time with
+``python -m gnipy._aot``. Otherwise every loop in this module is ``None``,
+and :class:`gnipy.core.Integrator` falls back to plain Python loops.
+
+GNIPY is available under GNU GPL v3 license.
+Documentation guidelines are available `here <https://github.com/numpy/numpy/blob/master/doc/HOWTO_DOCUMENT.rst.txt>`_.
+"""
+
+from numpy import ndarray
+
+try:
+	import numba
+except ImportError:
+	numba = None
+
+# Arrays with fewer elements are processed by a single thread, since
+# starting the threads would cost more than it saves.
+PARALLEL_MIN_SIZE = 8192
+
+# The array loops below update independent elements, so they take all
+# the steps on one tile of elements before moving on to the next.
+# Each tile is copied to a work array, which stays in the L1 cache
+# and, not being aliased, lets the compiler vectorise the updates.
+# The state arrays are thus read from and written to memory only once.
+TILE_SIZE = 256
+
+
+def _jit(**options):
+	"""
+	Decorator compiling a loop in nopython mode, or replacing it
+	with ``None`` if Numba is not available.
+	"""
+	def decorator(func):
+		if numba is None:
+			return None
+		return numba.njit(**options)(func)
+	return decorator
+
+
+# Not cached: Numba cannot cache functions taking other functions
+@_jit()
+def run_loop(step, stepsize, state, nsteps):
+	"""
+	Take `nsteps` steps with the compiled step function `step`.
+
+	The function `step` has the same signature as
+	:meth:`gnipy.core.Integrator.__call__`, i.e., ``step(stepsize, state)``,
+	and must itself be compiled with ``numba.njit``.
+	The interpreter is not entered between the steps.
+	"""
+	for k in range(nsteps):
+		state = step(stepsize, state)
+	return state
+
+
+def _check_array(y):
+	"""
+	Raise AttributeError unless `y` is a C contiguous float or complex array.
+	"""
+	if (y.dtype.kind not in 'fc'):
+		raise AttributeError("Object %s must be a float or complex array."%str(y.dtype))
+	if (not y.flags.c_contiguous):
+		raise AttributeError("Object %s must be a C contiguous array."%str(type(y)))
+
+
+def scalar_mul_loop(y, factor, nsteps):
+	"""
+	Multiply `y` by `factor`, `nsteps` times.
+
+	This is the whole integration loop of any one-step method for the
+	linear test equation y' = lam*y, e.g., the explicit Euler method
+	with ``factor = 1+stepsize*lam``. A contiguous array `y` is updated
+	in place, tile by tile. A scalar `y` is kept in registers throughout, instead of
+	being wrapped in an array.
+	"""
+	if isinstance(y,ndarray):
+		_check_array(y)
+		return _scalar_mul_array(y, factor, nsteps)
+	return _scalar_mul_number(y, factor, nsteps)
+
+
+@_jit(cache=True, parallel=True, fastmath=True)
+def _scalar_mul_array(y, factor, nsteps):
+	flat = y.reshape(y.size)
+	ntiles = (flat.size+TILE_SIZE-1)//TILE_SIZE
+	if flat.size < PARALLEL_MIN_SIZE:
+		for t in range(ntiles):
+			_scalar_mul_tile(flat, t*TILE_SIZE, min((t+1)*TILE_SIZE,flat.size), factor, nsteps)
+	else:
+		for t in numba.prange(ntiles):
+			_scalar_mul_tile(flat, t*TILE_SIZE, min((t+1)*TILE_SIZE,flat.size), factor, nsteps)
+	return y
+
+
+@_jit(cache=True, fastmath=True)
+def _scalar_mul_tile(flat, start, stop, factor, nsteps):
+	tile = flat[start:stop].copy()
+	for k in range(nsteps):
+		for i in range(tile.size):
+			tile[i] *= factor
+	flat[start:stop] = tile
+
+
+@_jit(cache=True)
+def _scalar_mul_number(y, factor, nsteps):
+	for k in range(nsteps):
+		y *= factor
+	return y
+
+
+def sv_loop(state, stepsize, nsteps):
+	"""
+	Integrate the harmonic oscillator q' = p, p' = -q with `nsteps`
+	steps of the Stormer-Verlet method.
+
+	The state is a tuple (q,p) of either contiguous arrays of equal
+	shape, which are updated in place, or scalars. For arrays, the
+	kick-drift-kick sequence is fused into a single pass over each
+	tile per step, without temporary arrays.
+	"""
+	(q,p) = state
+	if isinstance(q,ndarray):
+		if (not isinstance(p,ndarray) or q.shape != p.shape):
+			raise AttributeError("Arrays q and p must have the same shape.")
+		_check_array(q)
+		_check_array(p)
+		return _sv_array(q, p, stepsize, nsteps)
+	return _sv_number(q, p, stepsize, nsteps)
+
+
+@_jit(cache=True, parallel=True, fastmath=True)
+def _sv_array(q, p, stepsize, nsteps):
+	qflat = q.reshape(q.size)
+	pflat = p.reshape(p.size)
+	ntiles = (qflat.size+TILE_SIZE-1)//TILE_SIZE
+	if qflat.size < PARALLEL_MIN_SIZE:
+		for t in range(ntiles):
+			_sv_tile(qflat, pflat, t*TILE_SIZE, min((t+1)*TILE_SIZE,qflat.size), stepsize, nsteps)
+	else:
+		for t in numba.prange(ntiles):
+			_sv_tile(qflat, pflat, t*TILE_SIZE, min((t+1)*TILE_SIZE,qflat.size), stepsize, nsteps)
+	return (q,p)
+
+
+@_jit(cache=True, fastmath=True)
+def _sv_tile(q, p, start, stop, stepsize, nsteps):
+	qtile = q[start:stop].copy()
+	ptile = p[start:stop].copy()
+	half = 0.5*stepsize
+	for k in range(nsteps):
+		for i in range(qtile.size):
+			qtile[i] += half*ptile[i]
+			ptile[i] -= stepsize*qtile[i]
+			qtile[i] += half*ptile[i]
+	q[start:stop] = qtile
+	p[start:stop] = ptile
+
+
+@_jit(cache=True)
+def _sv_number(q, p, stepsize, nsteps):
+	half = 0.5*stepsize
+	for k in range(nsteps):
+		q += half*p
+		p -= stepsize*q
+		q += half*p
+	return (q,p)
+
+
+def rk4_loop(y, f, k, tmp, stepsize, nsteps):
+	"""
+	Integrate y' = f(y) in place with `nsteps` steps of the classical
+	fourth order Runge-Kutta method.
+
+	The vector field is called as f(y, out) and must be compiled with
+	``numba.njit``. The arrays `k`, of shape (4,)+y.shape, and `tmp`,
+	of shape y.shape, hold the stages. Forming the stage arguments and
+	the update are each fused into a single pass over the arrays.
+	The state `y` must be a C contiguous array of the same shape as `tmp`.
+	"""
+	if (not isinstance(y,ndarray) or y.shape != tmp.shape):
+		raise AttributeError("State must be an array of shape %s."%str(tmp.shape))
+	_check_array(y)
+	return _rk4_loop(y, f, k, tmp, stepsize, nsteps)
+
+
+# Not cached: Numba cannot cache functions taking other functions
+@_jit(fastmath=True)
+def _rk4_loop(y, f, k, tmp, stepsize, nsteps):
+	n = y.size
+	yflat = y.reshape(n)
+	kflat = k.reshape((4,n))
+	tmpflat = tmp.reshape(n)
+	half = 0.5*stepsize
+	sixth = stepsize/6.0
+	for s in range(nsteps):
+		f(y, k[0])
+		for i in range(n):
+			tmpflat[i] = yflat[i] + half*kflat[0,i]
+		f(tmp, k[1])
+		for i in range(n):
+			tmpflat[i] = yflat[i] + half*kflat[1,i]
+		f(tmp, k[2])
+		for i in range(n):
+			tmpflat[i] = yflat[i] + stepsize*kflat[2,i]
+		f(tmp, k[3])
+		for i in range(n):
+			yflat[i] += sixth*(kflat[0,i] + 2.0*(kflat[1,i]+kflat[2,i]) + kflat[3,i])
+	return y
+
+
+# Fall back to the loops compiled ahead of time, see gnipy/_aot.py
+_aot = None
+if numba is None:
+	try:
+		from gnipy import gnipy_kernels as _aot
+	except ImportError:
+		pass
+
+if _aot is not None:
+	from numpy import float64, complex128, iscomplexobj
+
+	def _flat(y):
+		"""
+		Return the C contiguous array `y` as a flat view.
+		"""
+		if (not y.flags.c_contiguous):
+			raise AttributeError("Object %s must be a C contiguous array."%str(type(y)))
+		return y.reshape(y.size)
+
+	def _scalar_mul_array(y, factor, nsteps):
+		if (y.dtype == float64):
+			_aot.scalar_mul_array_f8(_flat(y), float(factor), nsteps)
+		elif (y.dtype == complex128):
+			_aot.scalar_mul_array_c16(_flat(y), complex(factor), nsteps)
+		else:
+			raise AttributeError("Object %s must be a float64 or complex128 array."%str(y.dtype))
+		return y
+
+	def _scalar_mul_number(y, factor, nsteps):
+		if (iscomplexobj(y) or iscomplexobj(factor)):
+			return _aot.scalar_mul_number_c16(complex(y), complex(factor), nsteps)
+		return _aot.scalar_mul_number_f8(float(y), float(factor), nsteps)
+
+	def _sv_array(q, p, stepsize, nsteps):
+		_aot.sv_array(_flat(q), _flat(p), float(stepsize), nsteps)
+		return (q,p)
+
+	def _sv_number(q, p, stepsize, nsteps):
+		return _aot.sv_number(float(q), float(p), float(stepsize), nsteps)
+
+if numba is None and _aot is None:
+	scalar_mul_loop = None
+	sv_loop = None
+
+if numba is None:
+	rk4_loop = None
@@ -9,8 +9,75 @@ Documentation guidelines are available `here <https://github.com/numpy/numpy/blo
 Created by Klas Modin on 2014-05-12.
 """
 
-from numpy import array, dot, ones, zeros, hstack, asarray, ndarray
-from numpy import diag, triu, isscalar, linspace, shape
+import warnings
+
+from numpy import asarray, hstack, isscalar
+
+try:
+	xrange
+except NameError:
+	xrange = range
+
+
+def _map_arrays(func, state):
+	"""
+	Apply `func` to every array of a state, which may be a nested tuple.
+	"""
+	if isinstance(state,tuple):
+		return tuple(_map_arrays(func,s) for s in state)
+	return func(state)
+
+
+def _nsteps(totaltime, stepsize):
+	"""
+	Return the number of steps of size `stepsize` that make up `totaltime`.
+
+	A warning is issued if `totaltime` is not a multiple of `stepsize`,
+	since the integration then does not end at `totaltime`.
+	"""
+	ratio = float(totaltime)/stepsize
+	nsteps = int(round(ratio))
+	if abs(ratio-nsteps) > 1e-8*max(1.0,abs(ratio)):
+		warnings.warn("Total time %s is not a multiple of step size %s; taking %d steps."%(str(totaltime),str(stepsize),nsteps), stacklevel=3)
+	return nsteps
+
+# Compositions of at most this many methods get an unrolled step function
+UNROLL_MAX = 8
+
+def _unrolled_step(steps, stepsizes, loop=False):
+	"""
+	Return the function state -> steps[n-1](stepsizes[n-1], ... steps[0](stepsizes[0], state)),
+	generated with one line per method instead of a loop.
+
+	Real step sizes are written into the generated code as constants.
+	If `loop` is true, the function instead has the signature
+	(state, nsteps) and takes `nsteps` such steps.
+	"""
+	namespace = {'xrange': xrange}
+	if loop:
+		src = 'def step(state, nsteps):\n\tfor k in xrange(nsteps):\n'
+		indent = '\t\t'
+	else:
+		src = 'def step(state):\n'
+		indent = '\t'
+	for i in range(len(steps)):
+		namespace['s%d'%i] = steps[i]
+		src += indent+'state = s%d(%s, state)\n'%(i,_literal('h%d'%i,stepsizes[i],namespace))
+	if len(steps) == 0:
+		src += indent+'pass\n'
+	src += '\treturn state\n'
+	exec(src, namespace)
+	return namespace['step']
+
+def _literal(name, value, namespace):
+	"""
+	Return source code for `value`: a literal if it is a finite real
+	number, otherwise `name`, after binding `value` to it in `namespace`.
+	"""
+	if type(value) in (int, float) and value-value == 0:
+		return repr(value)
+	namespace[name] = value
+	return name
 
 
 class Solver(object):	
@@ -27,18 +94,34 @@ class Solver(object):
 		raise NotImplementedError(':meth:`integrate` method for class %s is not implemented.'%str(type(self)))
 
 class Integrator(Solver):
-	"""
+	r"""
 	Numerical flow map :math:`\Phi` of the form :math:`y_{k+1} = \Phi(h,y_{k})`, 
 	where :math:`h` is the step size and :math:`y_k` is the state variable.
 	"""
 
+	# Step function compiled with numba.njit, used by :meth:`run_last`.
+	# Same signature as :meth:`__call__`. None means no compiled step.
+	_jitstep = None
+
+	# Compiled loop carrying out the whole integration, used by
+	# :meth:`run_last` in favour of `_jitstep`. It is called as
+	# _kernel(state, *(self.prepare(stepsize)+(nsteps,))).
+	_kernel = None
+
+	# CUDA loop integrating an ensemble of states with one GPU thread
+	# per member, used by :meth:`run_batch`. Same call as `_kernel`.
+	_cuda_kernel = None
+
 	def run(self, totaltime, stepsize, state, *args, **kwargs):
 		"""
 		Carry out the integration process.
 
 		A generator is returned that succesively uses the
-			self.__call__(self, stepsize, state, *args, **kwargs) 
-		method, yielding the succesive states (as reference, not copy).
+			self.__call__(stepsize, state)
+		method, or the
+			self.call_with(stepsize, state, *args, **kwargs)
+		method if extra arguments are given, yielding the succesive
+		states (as reference, not copy).
 
 		Parameters
 		----------
@@ -49,9 +132,9 @@ class Integrator(Solver):
 		stepsize : float
 			Time increment between steps.
 		*args : list
-			Arbitrary number of arguments to be passed too self.__call__.
+			Arbitrary number of arguments to be passed to self.call_with.
 		**kwargs : dictionary
-			Arbitrary number of keyword arguments to be passed to self.__call__.
+			Arbitrary number of keyword arguments to be passed to self.call_with.
 
 		Returns
 		-------
@@ -59,38 +142,157 @@ class Integrator(Solver):
 
 		See also
 		--------
-		N/A
+		run_last : Faster, if only the final state is needed.
 
 		Examples
 		--------
 		N/A
 		"""
-		nsteps = int(round(float(totaltime)/stepsize))
+		nsteps = _nsteps(totaltime, stepsize)
+		bind = getattr(self, 'bind_stepsize', None)
+
+		# Main integration loop
+		if args or kwargs:
+			step = self.call_with
+			for k in xrange(nsteps):
+				state = step(stepsize,state,*args,**kwargs)
+				yield state
+		elif bind is not None:
+			step = bind(stepsize)
+			for k in xrange(nsteps):
+				state = step(state)
+				yield state
+		else:
+			step = self.__call__
+			for k in xrange(nsteps):
+				state = step(stepsize,state)
+				yield state
+
+	def run_last(self, totaltime, stepsize, state):
+		"""
+		Carry out the integration process and return the final state only.
+
+		Use this instead of exhausting :meth:`run` when the intermediate
+		states are not needed; no generator is suspended and resumed
+		in every step.
+
+		If the integrator provides a compiled loop in `_kernel`, or a
+		compiled step function in `_jitstep`, the whole loop is carried
+		out in compiled code, without entering the interpreter between
+		the steps. Otherwise, self.__call__(stepsize, state) is used
+		as in :meth:`run`.
+
+		Parameters
+		----------
+		totaltime : float
+			Total integration time.
+		stepsize : float
+			Time increment between steps.
+		state : array_like
+			Initial state array (can have any shape).
+
+		Returns
+		-------
+		Final state (as reference, not copy).
+
+		See also
+		--------
+		run
+		"""
+		nsteps = _nsteps(totaltime, stepsize)
+
+		if self._kernel is not None:
+			return self._kernel(state, *(self.prepare(stepsize)+(nsteps,)))
+
+		if self._jitstep is not None:
+			from ._runner import run_loop
+			return run_loop(self._jitstep, stepsize, state, nsteps)
+
+		return self._run_steps(nsteps, stepsize, state)
+
+	def run_batch(self, totaltime, stepsize, states, backend='numpy'):
+		"""
+		Carry out the integration process for an ensemble of initial states.
+
+		The first axis of every array in `states` indexes the ensemble,
+		so `states` has the same structure as the state for
+		:meth:`run_last`, with one extra leading axis. Each step
+		thereby acts on the whole ensemble at once.
+
+		Parameters
+		----------
+		totaltime : float
+			Total integration time.
+		stepsize : float
+			Time increment between steps.
+		states : array_like
+			Initial states, stacked along the first axis.
+		backend : {'numpy', 'cupy', 'cuda'}
+			With 'numpy', the states are integrated in place as in
+			:meth:`run_last`. With 'cupy', they are copied to the GPU,
+			integrated there with self.__call__(stepsize, state),
+			and the final states are copied back to new arrays.
+			With 'cuda', the compiled loop `_cuda_kernel` integrates
+			each member in its own GPU thread, and the final states
+			are copied back in place. This pays off for large
+			ensembles only.
+
+		Returns
+		-------
+		Final states.
+
+		See also
+		--------
+		run_last
+		"""
+		if backend == 'numpy':
+			return self.run_last(totaltime, stepsize, states)
+		if backend == 'cupy':
+			import cupy
+			nsteps = _nsteps(totaltime, stepsize)
+			states = _map_arrays(cupy.asarray, states)
+			states = self._run_steps(nsteps, stepsize, states)
+			return _map_arrays(cupy.asnumpy, states)
+		if backend == 'cuda':
+			if self._cuda_kernel is None:
+				raise AttributeError("Integrator %s has no CUDA kernel."%str(type(self)))
+			nsteps = _nsteps(totaltime, stepsize)
+			return self._cuda_kernel(states, *(self.prepare(stepsize)+(nsteps,)))
+		raise AttributeError("Backend %s is not supported."%str(backend))
+
+	def _run_steps(self, nsteps, stepsize, state):
+		"""
+		Take `nsteps` steps in a Python loop and return the final state.
+		"""
+		bind = getattr(self, 'bind_loop', None)
+		if bind is not None:
+			return bind(stepsize)(state, nsteps)
 
 		# Main integration loop
+		step = self.__call__
 		for k in xrange(nsteps):
-			state = self.__call__(stepsize,state)
-			yield state
-
-
-		# if isscalar(yinit):
-		# 	y = asarray(yinit)
-		# else:
-		# 	y = array(yinit)
-		# nout = int(round(float(tspan)/stepsize))
-		# tout = linspace(0,tspan,nout)
-		# yout = zeros(hstack((nout,shape(y))),dtype=y.dtype)
-		# yout[0] = y
-
-		# # Main integration loop
-		# for i in xrange(1,nout):
-		# 	# self.__call__(stepsize,y)
-		# 	y = self.__call__(stepsize,y)
-		# 	yout[i] = y
-		# 	# yout[i] = self.__call__(stepsize,yout[i-1])
-		
-		# return (tout,yout)
-	
+			state = step(stepsize,state)
+		return state
+
+	def prepare(self, stepsize):
+		"""
+		Return the constants of the method for a fixed step size.
+
+		Called once per integration by :meth:`run_last`, which passes
+		the returned tuple on to the compiled loop `_kernel`.
+		The default implementation returns an empty tuple.
+
+		Parameters
+		----------
+		stepsize : float
+			Time increment between steps.
+
+		Returns
+		-------
+		tuple
+		"""
+		return ()
+
 	def __call__(self, stepsize, state, *args, **kwargs):
 		"""
 		Evaluation of the numerical flow function.
@@ -100,6 +302,18 @@ class Integrator(Solver):
 		The variable 'y' is typically overwritten (for efficiency).
 		"""
 		raise NotImplementedError(':meth:`__call__` method for class %s is not defined.'%str(type(self)))
+
+	def call_with(self, stepsize, state, *args, **kwargs):
+		"""
+		Evaluation of the numerical flow function with extra arguments.
+
+		Methods that take extra arguments accept them in :meth:`__call__`
+		after `state`. Keeping them out of the plain two-argument call
+		spares the packing of argument tuples and dictionaries in
+		every step when no extra arguments are used.
+		The default implementation passes them on to :meth:`__call__`.
+		"""
+		return self.__call__(stepsize, state, *args, **kwargs)
 	
 	def __mul__(self,other):
 		"""
@@ -114,14 +328,14 @@ class Integrator(Solver):
 		if (not isinstance(other,Integrator)):
 			raise AttributeError("Object %s must be a Integrator."%str(other))
 		if (isinstance(self,Composition)):
-			mclist_self = self.mclist
+			(methods_self,coefs_self) = (self._methods,self._coefs)
 		else:
-			mclist_self = [(self,1.0)]
+			(methods_self,coefs_self) = ((self,),(1.0,))
 		if (isinstance(other,Composition)):
-			mclist_other = other.mclist
+			(methods_other,coefs_other) = (other._methods,other._coefs)
 		else:
-			mclist_other = [(other,1.0)]
-		return Composition(mclist_self+mclist_other)
+			(methods_other,coefs_other) = ((other,),(1.0,))
+		return Composition.from_schedule(methods_self+methods_other, hstack((coefs_self,coefs_other)))
 	
 	def __pow__(self,coeff):
 		"""
@@ -134,7 +348,7 @@ class Integrator(Solver):
 		"""
 		if (not isscalar(coeff)):
 			raise AttributeError("Object %s must be a scalar."%str(coeff))
-		return Composition([(self,coeff)])
+		return Composition.from_schedule((self,), asarray([coeff]))
 	
 
 class Composition(Integrator):
@@ -154,20 +368,119 @@ class Composition(Integrator):
 			method, and the coefficient for that method.
 		"""
 		super(Composition, self).__init__()
-		self.mclist = mclist
+		self._set_schedule(tuple(m for (m,c) in mclist), asarray([c for (m,c) in mclist]))
+
+	@classmethod
+	def from_schedule(cls, methods, coefs):
+		"""
+		Construct composition integrator from its schedule.
+
+		Parameters
+		----------
+		methods : tuple of Integrator
+			The methods, in the order they are applied.
+		coefs : ndarray
+			The coefficients for the methods.
+		"""
+		comp = cls.__new__(cls)
+		super(Composition, comp).__init__()
+		comp._set_schedule(methods, coefs)
+		return comp
+
+	def _set_schedule(self, methods, coefs):
+		self._methods = methods
+		self._coefs = coefs
+		self._steps = tuple(m.__call__ for m in methods)
+		# Pair (stepsize,step function) for the last stepsize used in __call__
+		self._bound = (None, None)
+
+	@property
+	def mclist(self):
+		"""
+		List of tuples (Integrator,coeff) making up the composition.
+		"""
+		return list(zip(self._methods, self._coefs.tolist()))
 	
-	def __call__(self, stepsize, state, *args, **kwargs):
-		for (m,c) in self.mclist:
-			state = m.__call__(c*stepsize, state, *args, **kwargs)
+	def __call__(self, stepsize, state):
+		(h,step) = self._bound
+		if stepsize != h:
+			step = self._scaled_step(stepsize)
+			self._bound = (stepsize,step)
+		return step(state)
+
+	def call_with(self, stepsize, state, *args, **kwargs):
+		for (m,c) in zip(self._methods, self._coefs.tolist()):
+			state = m.call_with(c*stepsize, state, *args, **kwargs)
 		return state
 	
+	def bind_stepsize(self, stepsize):
+		"""
+		Return the composition as a step function for a fixed step size.
+
+		The step sizes c*stepsize of the methods are computed once,
+		instead of in every step. For compositions of at most
+		UNROLL_MAX methods, the loop over the methods is unrolled.
+
+		Parameters
+		----------
+		stepsize : float
+			Time increment between steps.
+
+		Returns
+		-------
+		Function state -> self(stepsize,state).
+		"""
+		if len(self._steps) <= UNROLL_MAX:
+			return _unrolled_step(self._steps, (self._coefs*stepsize).tolist())
+		return self._scaled_step(stepsize)
+
+	def _scaled_step(self, stepsize):
+		"""
+		Return the step function state -> self(stepsize,state) as a loop
+		over the methods and their step sizes c*stepsize.
+
+		Unlike :meth:`bind_stepsize`, no code is generated, so this is
+		cheap enough to be called whenever the step size changes.
+		"""
+		scaled = tuple(zip(self._steps, (self._coefs*stepsize).tolist()))
+		def step(state):
+			for (m,h) in scaled:
+				state = m(h, state)
+			return state
+		return step
+
+	def bind_loop(self, stepsize):
+		"""
+		Return the integration loop of the composition for a fixed step size.
+
+		For compositions of at most UNROLL_MAX methods, the loop is
+		generated with the methods unrolled into its body and the
+		step sizes c*stepsize written in as constants, so that each
+		step costs one call per method only.
+
+		Parameters
+		----------
+		stepsize : float
+			Time increment between steps.
+
+		Returns
+		-------
+		Function (state,nsteps) -> state after nsteps steps.
+		"""
+		stepsizes = (self._coefs*stepsize).tolist()
+		if len(self._steps) <= UNROLL_MAX:
+			return _unrolled_step(self._steps, stepsizes, loop=True)
+		step = self.bind_stepsize(stepsize)
+		def loop(state, nsteps):
+			for k in xrange(nsteps):
+				state = step(state)
+			return state
+		return loop
+
 	def __pow__(self,coeff):
 		if (not isscalar(coeff)):
 			raise AttributeError("Object %s must be a scalar."%str(coeff))
-		mclist_new = []
-		for (m,c) in self.mclist:
-			mclist_new += [(m,coeff*c)]
-		return Composition(mclist_new)
+		return Composition.from_schedule(self._methods, coeff*self._coefs)
 	
 	def __str__(self):
 		namestr = ''
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Standard integration methods for the GNIPY library.
+
+GNIPY is available under GNU GPL v3 license.
+Documentation guidelines are available `here <https://github.com/numpy/numpy/blob/master/doc/HOWTO_DOCUMENT.rst.txt>`_.
+"""
+
+from numpy import empty, add, multiply
+
+from .core import Integrator
+
+
+class RK4(Integrator):
+	r"""
+	The classical fourth order Runge-Kutta method for :math:`\dot y = f(y)`.
+
+	All intermediate stages are kept in work arrays allocated once, in
+	the constructor, so that no arrays are allocated during the steps.
+	The state is overwritten by each step.
+	"""
+	name = "RK4"
+
+	def __init__(self, f, shape, dtype=float, jit=False):
+		"""
+		Constructor for RK4 integrator.
+
+		Parameters
+		----------
+		f : callable
+			Vector field, called as f(y, out). It must write f(y) to
+			the array `out` (of the same shape as `y`) instead of
+			returning it.
+		shape : int or tuple of ints
+			Shape of the state array.
+		dtype : data-type
+			Data type of the state array.
+		jit : bool
+			If true, `f` must be compiled with ``numba.njit``, and
+			:meth:`run_last` then carries out the whole integration
+			in compiled code (if Numba is available).
+		"""
+		super(RK4, self).__init__()
+		self.f = f
+		self._tmp = empty(shape, dtype=dtype)
+		self._k = empty((4,)+self._tmp.shape, dtype=dtype)
+		if jit:
+			from ._runner import rk4_loop
+			self._kernel = rk4_loop
+
+	def prepare(self, stepsize):
+		return (self.f, self._k, self._tmp, stepsize)
+
+	def __call__(self, stepsize, state):
+		f = self.f
+		(k1,k2,k3,k4) = self._k
+		tmp = self._tmp
+		f(state, k1)
+		multiply(k1, 0.5*stepsize, out=tmp)
+		add(state, tmp, out=tmp)
+		f(tmp, k2)
+		multiply(k2, 0.5*stepsize, out=tmp)
+		add(state, tmp, out=tmp)
+		f(tmp, k3)
+		multiply(k3, stepsize, out=tmp)
+		add(state, tmp, out=tmp)
+		f(tmp, k4)
+		# state += stepsize/6*(k1+2*(k2+k3)+k4)
+		add(k2, k3, out=k2)
+		multiply(k2, 2.0, out=k2)
+		add(k1, k2, out=k1)
+		add(k1, k4, out=k1)
+		multiply(k1, stepsize/6.0, out=k1)
+		add(state, k1, out=state)
+		return state
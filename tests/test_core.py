@@ -12,6 +12,22 @@ Created by Klas Modin on 2014-06-27.
 import numpy as np
 import gnipy as gp
 import itertools as it
+import warnings
+import pytest
+from gnipy import _runner, _csteppers, _cuda
+
+try:
+	from numba import njit
+except ImportError:
+	njit = None
+
+def jitstep(func):
+	"""
+	Compile a step function with Numba, if available, for use as _jitstep.
+	"""
+	if njit is None:
+		return None
+	return staticmethod(njit(cache=True)(func))
 
 # Define various integrators to be tested
 
@@ -20,42 +36,98 @@ class Identity(gp.Integrator):
 	def __call__(self, stepsize, state):
 		return state
 
+	_jitstep = jitstep(lambda stepsize, state: state)
+
 class DahlquistExplicitEuler(gp.Integrator):
 
 	def __init__(self, lam=-1.0):
 		self.lam = lam
+		if njit is not None:
+			@njit
+			def jitstep(stepsize, state):
+				state *= 1.0+stepsize*lam
+				return state
+			self._jitstep = jitstep
 
 	def __call__(self, stepsize, state):
 		state *= 1.0+stepsize*self.lam
 		return state
 
+	def prepare(self, stepsize):
+		return (1.0+stepsize*self.lam,)
+
+class DahlquistExplicitEulerKernel(DahlquistExplicitEuler):
+
+	_kernel = staticmethod(_runner.scalar_mul_loop)
+	_cuda_kernel = staticmethod(_cuda.scalar_mul_loop)
+
+class DahlquistExplicitEulerC(DahlquistExplicitEuler):
+
+	_kernel = staticmethod(_csteppers.dahlquist)
+
 class NonNumPyIntegrator(gp.Integrator):
 
-	def __call__(self, stepsize, ((q,p),a)):
+	def __call__(self, stepsize, state):
+		((q,p),a) = state
 		q += stepsize*p
 		p -= stepsize*q
 		a -= stepsize
 		return ((q,p),a)
 
+def verlet_a(stepsize, state):
+	(q,p) = state
+	q += stepsize*p
+	return (q,p)
+
+def verlet_b(stepsize, state):
+	(q,p) = state
+	p -= stepsize*q
+	return (q,p)
+
+def stormer_verlet(stepsize, state):
+	(q,p) = state
+	half = stepsize/2.0
+	q += half*p
+	p -= stepsize*q
+	q += half*p
+	return (q,p)
+
+class DahlquistParametric(gp.Integrator):
+
+	def __call__(self, stepsize, state, lam=-1.0):
+		state *= 1.0+stepsize*lam
+		return state
+
+def oscillator(y, out):
+	out[0] = y[1]
+	out[1] = -y[0]
+
 class VerletA(gp.Integrator):
 
-	def __call__(self, stepsize, (q,p)):
-		q += stepsize*p
-		return (q,p)
+	__call__ = staticmethod(verlet_a)
+	_jitstep = jitstep(verlet_a)
 
 class VerletB(gp.Integrator):
 
-	def __call__(self, stepsize, (q,p)):
-		p -= stepsize*q
-		return (q,p)
+	__call__ = staticmethod(verlet_b)
+	_jitstep = jitstep(verlet_b)
 
 class StormerVerlet(gp.Integrator):
-	def __call__(self, stepsize, (q,p)):
-		half = stepsize/2.0
-		q += half*p
-		p -= stepsize*q
-		q += half*p
-		return (q,p)
+
+	__call__ = staticmethod(stormer_verlet)
+	_jitstep = jitstep(stormer_verlet)
+
+	def prepare(self, stepsize):
+		return (stepsize,)
+
+class StormerVerletKernel(StormerVerlet):
+
+	_kernel = staticmethod(_runner.sv_loop)
+	_cuda_kernel = staticmethod(_cuda.sv_loop)
+
+class StormerVerletC(StormerVerlet):
+
+	_kernel = staticmethod(_csteppers.stormer_verlet)
 
 
 # Define test class
@@ -64,38 +136,132 @@ class TestCore(object):
 	identity = Identity()
 	sol1 = DahlquistExplicitEuler()
 	sol2 = DahlquistExplicitEuler(1.0j)
+	sol1k = DahlquistExplicitEulerKernel()
+	sol2k = DahlquistExplicitEulerKernel(1.0j)
 	sol3 = NonNumPyIntegrator()
 	solA = VerletA()
 	solB = VerletB()
 	sol_sv = StormerVerlet()
+	sol_svk = StormerVerletKernel()
+	sol1c = DahlquistExplicitEulerC()
+	sol_svc = StormerVerletC()
 
 	def test_identity(self):
-		y = np.ones(1e6,dtype=float)
+		y = np.ones(10**6,dtype=float)
 		y2 = y
-		for y in self.identity.run(totaltime=1.0, stepsize=1e-6, state=y): pass
+		y = self.identity.run_last(totaltime=1.0, stepsize=1e-6, state=y)
 		assert(y is y2)
 
 	def test_large(self):
-		y = np.ones(1e6,dtype=float)
-		for y in self.sol1.run(totaltime=1.0, stepsize=1e-3, state=y): pass
+		y = np.ones(10**6,dtype=float)
+		y = self.sol1k.run_last(totaltime=1.0, stepsize=1e-3, state=y)
 		np.testing.assert_allclose(y[:2],np.array([0.36769542,0.36769542]),atol=1e-8,rtol=1e-8)
 
+	def test_run_last(self):
+		y = np.ones(10,dtype=complex)
+		for y1 in self.sol2.run(1.0, 1e-3, y.copy()): pass
+		y2 = self.sol2.run_last(1.0, 1e-3, y.copy())
+		np.testing.assert_allclose(y2,y1,atol=1e-14)
+		y3 = self.sol2k.run_last(1.0, 1e-3, y.copy().reshape(2,5))
+		np.testing.assert_allclose(y3.ravel(),y1,atol=1e-12)
+
+	def test_kernel_errors(self):
+		if _runner.scalar_mul_loop is None:
+			pytest.skip("No compiled loops (Numba or gnipy_kernels) available.")
+		for y in [np.ones(4,dtype=int), np.ones((4,3))[:,0], np.ones((4,3),order='F')]:
+			with pytest.raises(AttributeError):
+				self.sol1k.run_last(1.0, 1e-3, y)
+
+	def test_run_batch(self):
+		y = np.ones((4,10),dtype=complex)
+		y[1:] *= np.arange(2,5)[:,np.newaxis]
+		y1 = self.sol2.run_last(1.0, 1e-3, y[2].copy())
+		y2 = self.sol2.run_batch(1.0, 1e-3, y)
+		np.testing.assert_allclose(y2[2],y1,atol=1e-14)
+		q = np.ones((3,100),dtype=float)
+		p = np.zeros_like(q)
+		(q1,p1) = self.sol_sv.run_last(1.0, 1e-3, (q[0].copy(),p[0].copy()))
+		(q2,p2) = self.sol_svk.run_batch(1.0, 1e-3, (q,p))
+		np.testing.assert_allclose(q2[-1],q1,atol=1e-13)
+		np.testing.assert_allclose(p2[-1],p1,atol=1e-13)
+		for (sol,backend) in [(self.sol1,'fortran'),(self.sol_sv,'cuda')]:
+			with pytest.raises(AttributeError):
+				sol.run_batch(1.0, 1e-3, (q,p), backend=backend)
+
+	def test_run_batch_cuda(self):
+		if _cuda.cuda is None or not _cuda.cuda.is_available():
+			pytest.skip("CUDA (device or NUMBA_ENABLE_CUDASIM=1) is not available.")
+		y = np.ones((300,2),dtype=float)
+		y *= np.arange(1,301)[:,np.newaxis]
+		y1 = self.sol1k.run_batch(1.0, 1e-3, y.copy())
+		y2 = self.sol1k.run_batch(1.0, 1e-3, y, backend='cuda')
+		assert(y2 is y)
+		np.testing.assert_allclose(y2,y1,rtol=1e-14)
+		q = np.ones((300,3),dtype=float)
+		p = np.zeros_like(q)
+		(q1,p1) = self.sol_svk.run_batch(1.0, 1e-3, (q.copy(),p.copy()))
+		(q2,p2) = self.sol_svk.run_batch(1.0, 1e-3, (q,p), backend='cuda')
+		np.testing.assert_allclose(q2,q1,atol=1e-13)
+		np.testing.assert_allclose(p2,p1,atol=1e-13)
+		with pytest.raises(AttributeError):
+			self.sol1k.run_batch(1.0, 1e-3, np.ones((3,2),dtype=int), backend='cuda')
+		with pytest.raises(AttributeError):
+			self.sol_svk.run_batch(1.0, 1e-3, (np.ones((3,4)),np.zeros((3,2))), backend='cuda')
+		y = np.ones((0,2),dtype=float)
+		assert(self.sol1k.run_batch(1.0, 1e-3, y, backend='cuda') is y)
+		(q,p) = (np.ones((0,3)),np.zeros((0,3)))
+		(q2,p2) = self.sol_svk.run_batch(1.0, 1e-3, (q,p), backend='cuda')
+		assert(q2 is q and p2 is p)
+
+	def test_nsteps(self):
+		with warnings.catch_warnings(record=True) as w:
+			warnings.simplefilter('always')
+			y = self.sol1.run_last(1.0, 1e-3, 1.0)
+			assert(len(w) == 0)
+			y = self.sol1.run_last(1.0, 0.3, 1.0)
+			assert(len(w) == 1)
+			self.sol1.run_last(1.0, 0.3, 1.0)
+			assert(len(w) == 2)
+		np.testing.assert_allclose(y,0.7**3,atol=1e-15)
+		y = self.sol1.run_last(np.array(1.0), 0.25, 1.0)
+		np.testing.assert_allclose(y,0.75**4,atol=1e-15)
+
 	def test_complex(self):
 		y = np.ones(10,dtype=complex)
-		for y in self.sol2.run(1.0, 1e-3, y): pass
+		y = self.sol2.run_last(1.0, 1e-3, y)
 		yabs = abs(y)
 		np.testing.assert_allclose(yabs,1.,atol=1e-3)
 
+	def test_call_with(self):
+		sol = DahlquistParametric()**0.5*DahlquistParametric()**0.5
+		y1 = (self.sol2**0.5*self.sol2**0.5).run_last(1.0, 1e-3, np.ones(3,dtype=complex))
+		for y2 in sol.run(1.0, 1e-3, np.ones(3,dtype=complex), lam=1.0j): pass
+		np.testing.assert_allclose(y2,y1,atol=1e-14)
+		for y3 in sol.run(1.0, 1e-3, 1.0): pass
+		np.testing.assert_allclose(y3,0.36778736,atol=1e-6)
+
 	def test_scalar_dahlquist(self):
 		y = 1.0
-		for y in self.sol1.run(totaltime=1.0, stepsize=1e-3, state=y): pass
+		y = self.sol1.run_last(totaltime=1.0, stepsize=1e-3, state=y)
 		np.testing.assert_allclose(y,0.36769542,atol=1e-8,rtol=1e-8)
 
+	def test_scalar_kernels(self):
+		if _runner.scalar_mul_loop is None:
+			pytest.skip("No compiled loops (Numba or gnipy_kernels) available.")
+		y = self.sol1k.run_last(1.0, 1e-3, 1.0)
+		np.testing.assert_allclose(y,0.36769542,atol=1e-8,rtol=1e-8)
+		y1 = self.sol2.run_last(1.0, 1e-3, 1.0)
+		y2 = self.sol2k.run_last(1.0, 1e-3, 1.0)
+		np.testing.assert_allclose(y2,y1,atol=1e-14)
+		(q1,p1) = self.sol_sv.run_last(1.0, 1e-3, (1.0,0.0))
+		(q2,p2) = self.sol_svk.run_last(1.0, 1e-3, (1.0,0.0))
+		np.testing.assert_allclose([q2,p2],[q1,p1],atol=1e-14)
+
 	def test_nonnumpy(self):
 		q = np.ones(3,dtype=float)
 		p = np.zeros_like(q)
 		a = 1
-		for ((q,p),a) in self.sol3.run(totaltime=1.0, stepsize=1e-3, state=((q,p),a)): pass
+		((q,p),a) = self.sol3.run_last(totaltime=1.0, stepsize=1e-3, state=((q,p),a))
 		np.testing.assert_allclose(a,0.,atol=1e-15)
 		r = np.sqrt(q**2+p**2)
 		np.testing.assert_allclose(r,1.,atol=1e-3)
@@ -107,32 +273,110 @@ class TestCore(object):
 		gen = self.sol3.run(totaltime=1.0, stepsize=1e-3, state=((q,p),a))
 		try:
 			while True:
-				gen.next()
-		except StopIteration, e:
+				next(gen)
+		except StopIteration:
 			pass
 
 	def test_composition(self):
 		sol = self.sol2**0.5*self.sol1*self.sol2**0.5
 		y = np.ones(2,dtype=complex)
-		for y in sol.run(1.0, 1e-3, y): pass
+		y = sol.run_last(1.0, 1e-3, y)
 		yabs = abs(y)
 		np.testing.assert_allclose(yabs,0.36778736,atol=1e-6)
 
+	def test_composition_schedule(self):
+		sol = self.solA**0.5*self.solB*self.solA**0.5
+		assert(sol.mclist == [(self.solA,0.5),(self.solB,1.0),(self.solA,0.5)])
+		sol2 = (sol*sol)**0.5
+		assert(sol2.mclist == [(self.solA,0.25),(self.solB,0.5),(self.solA,0.25)]*2)
+		assert(str(sol2).count(' * ') == 5)
+
+	def test_composition_stepsize(self):
+		sol = self.sol2**0.5*self.sol1*self.sol2**0.5
+		y = np.ones(2,dtype=complex)
+		for y1 in sol.run(1.0, 1e-3, y.copy()): pass
+		for y2 in sol.run(1.0, 2e-3, y.copy()): pass
+		for y3 in sol.run(1.0, 1e-3, y.copy()): pass
+		np.testing.assert_allclose(y3,y1,atol=1e-15)
+		assert(not np.allclose(y2,y1,atol=1e-9,rtol=0))
+		y4 = sol.run_last(1.0, 1e-3, y.copy())
+		np.testing.assert_allclose(y4,y1,atol=1e-15)
+		y5 = sol.bind_stepsize(1e-3)(y.copy())
+		y6 = sol(1e-3, y.copy())
+		np.testing.assert_allclose(y5,y6,atol=1e-15)
+		y10 = sol(2e-3, sol(1e-3, y.copy()))
+		y11 = sol.bind_stepsize(2e-3)(sol.bind_stepsize(1e-3)(y.copy()))
+		np.testing.assert_allclose(y10,y11,atol=1e-15)
+		y9 = sol.bind_loop(1e-3)(y.copy(), 1000)
+		np.testing.assert_allclose(y9,y1,atol=1e-15)
+		empty = gp.core.Composition([])
+		assert(empty.run_last(1.0, 0.1, 1.0) == 1.0)
+		assert(empty(0.1, 1.0) == 1.0)
+		long_sol = sol**(1./3)*sol**(1./3)*sol**(1./3)
+		assert(len(long_sol.mclist) > gp.core.UNROLL_MAX)
+		y7 = long_sol.run_last(1.0, 1e-3, y.copy())
+		y8 = sol.run_last(1.0, 1e-3/3, y.copy())
+		np.testing.assert_allclose(y7,y8,atol=1e-14)
+
 	def test_verlet(self):
-		q = np.ones(1e5,dtype=float)
+		q = np.ones(10**5,dtype=float)
 		p = np.zeros_like(q)
-		for (q,p) in self.sol_sv.run(totaltime=1.0, stepsize=1e-3, state=(q,p)): pass
+		(q,p) = self.sol_sv.run_last(totaltime=1.0, stepsize=1e-3, state=(q,p))
 		r = np.sqrt(q**2+p**2)
 		np.testing.assert_allclose(r,1.,atol=1e-13)
 
+	def test_verlet_kernel(self):
+		if _runner.sv_loop is None:
+			pytest.skip("No compiled loops (Numba or gnipy_kernels) available.")
+		q = np.ones(10**5,dtype=float)
+		p = np.zeros_like(q)
+		(q1,p1) = self.sol_sv.run_last(1.0, 1e-3, (q.copy(),p.copy()))
+		(q2,p2) = self.sol_svk.run_last(1.0, 1e-3, (q,p))
+		assert(q2 is q and p2 is p)
+		np.testing.assert_allclose(q2,q1,atol=1e-13)
+		np.testing.assert_allclose(p2,p1,atol=1e-13)
+		with pytest.raises(AttributeError):
+			self.sol_svk.run_last(1.0, 1e-3, (np.ones(4),np.zeros(3)))
+
+	def test_c_kernels(self):
+		if _csteppers.dahlquist is None:
+			pytest.skip("C library libgnipy_csteppers.so is not built.")
+		y = self.sol1c.run_last(1.0, 1e-3, np.ones(100,dtype=float))
+		np.testing.assert_allclose(y,0.36769542,atol=1e-8,rtol=1e-8)
+		q = np.ones(100,dtype=float)
+		p = np.zeros_like(q)
+		(q1,p1) = self.sol_sv.run_last(1.0, 1e-3, (q.copy(),p.copy()))
+		(q2,p2) = self.sol_svc.run_last(1.0, 1e-3, (q,p))
+		np.testing.assert_allclose(q2,q1,atol=1e-13)
+		np.testing.assert_allclose(p2,p1,atol=1e-13)
+
+	def test_rk4(self):
+		y = np.zeros((2,100),dtype=float)
+		y[0] = 1.0
+		y = gp.RK4(oscillator, y.shape).run_last(1.0, 1e-2, y)
+		np.testing.assert_allclose(y[0],np.cos(1.0),atol=1e-10)
+		np.testing.assert_allclose(y[1],-np.sin(1.0),atol=1e-10)
+		f = oscillator if njit is None else njit(oscillator)
+		y2 = np.zeros((2,100),dtype=float)
+		y2[0] = 1.0
+		y2 = gp.RK4(f, y2.shape, jit=True).run_last(1.0, 1e-2, y2)
+		np.testing.assert_allclose(y2,y,atol=1e-14)
+		y3 = gp.RK4(oscillator, 2).run_last(1.0, 1e-2, np.array([1.0,0.0]))
+		np.testing.assert_allclose(y3,y[:,0],atol=1e-14)
+		if _runner.rk4_loop is not None:
+			sol = gp.RK4(f, 2, jit=True)
+			for y4 in [np.ones((2,2))[:,0], np.ones((2,1)), np.ones(2,dtype=int)]:
+				with pytest.raises(AttributeError):
+					sol.run_last(1.0, 1e-2, y4)
+
 	def test_verlet_composition(self):
 		q = np.ones(3,dtype=float)
 		p = np.zeros_like(q)
 		sol_v = self.solA**0.5*self.solB*self.solA**0.5
-		for (q,p) in sol_v.run(totaltime=1.0, stepsize=1e-3, state=(q,p)): pass
+		(q,p) = sol_v.run_last(totaltime=1.0, stepsize=1e-3, state=(q,p))
 		r = np.sqrt(q**2+p**2)
 		np.testing.assert_allclose(r,1.,atol=1e-13)
-		for (q,p) in self.sol_sv.run(totaltime=1.0, stepsize=1e-3, state=(q,-p)): pass
+		(q,p) = self.sol_sv.run_last(totaltime=1.0, stepsize=1e-3, state=(q,-p))
 		np.testing.assert_allclose(q,1.,atol=1e-12)
 		np.testing.assert_allclose(p,0.,atol=1e-12)
 